@@ -1,122 +1,1680 @@
 """
 	Pickle vs JSON by Konstantin Kovshenin
 	Feel free to use this code as you wish
-	
+
 	Discussions: http://kovshenin.com/archives/pickle-vs-json-which-is-faster/
 	Author: Konstantin Kovshenin -- http://kovshenin.com
-	Written in December 2010 for Python 2.6
-"""
+	Written in December 2010 for Python 2.6, now runs on Python 3.8+
 
-import simplejson
-import pickle
+	Every serializer lives in the codec registry below, so comparing marshal,
+	every pickle protocol or msgpack no longer means editing imports by hand:
 
-"""
-	Other things to try:
-	
-	# Marshal vs Simple JSON:
-	import marshal as pickle
-	import simplejson
-	
-	# Marshal vs Pickle:
-	import marshal as simplejson
-	import pickle
-	
-	# Marshal vs cPickle:
-	import marshal as simplejson
-	import cPickle as pickle
-	
-	# Simple JSON vs cPickle
-	import simplejson
-	import cPickle as pickle
+	python pickle_vs_json.py                      # everything installed
+	python pickle_vs_json.py --codecs 'pickle-*'  # pickle protocols only
+	python pickle_vs_json.py --codecs json,marshal
+	python pickle_vs_json.py --iterations 1000 --repeat 10
+	python pickle_vs_json.py --workers 8          # throughput on 1 to 8 cores
+	python pickle_vs_json.py --io                 # files, framed streams, mmap and pipes
+	python pickle_vs_json.py --modes entry,document,batch,oob --profile blobs
+	python pickle_vs_json.py --hotpath profiles/  # where does the time go?
+
+	Every run is saved as JSON and CSV under results/. Store one as the
+	baseline and later runs can be checked against it for regressions:
+
+	python pickle_vs_json.py --seed 1 --baseline
+	python pickle_vs_json.py --seed 1 && python pickle_vs_json.py compare
+
+	The payload defaults to the original lorem ipsum lists and dicts, see
+	--list for the other profiles or bring your own data:
+
+	python pickle_vs_json.py --profile records --param length=1000
+	python pickle_vs_json.py --sample our_cache_entries.json
 """
 
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import argparse
+import array
+import ast
+import collections
+import cProfile
+import csv
+import datetime
+import fnmatch
+import functools
+import glob
+import itertools
+import json
+import marshal
+import math
+import mmap
+import os
+import pickle
+import platform
+import pstats
+import statistics
+import struct
+import tempfile
+import threading
+import time
 import timeit
+import tracemalloc
 import random
+import shutil
 import sys
 
 source = []
-json_result = []
-pickle_result = []
-
-def main():
-	# Need access to these outside our functions.
-	global source, pickle_result, json_result
-	
-	# Let's generate some junky source - lists, dictionaries and nested dictionaries.
-	for i in range(10):
-		l, d, nd = get_data(50)
-		source.append(l)
-		source.append(d)
-		source.append(nd)
-		
-	# We'll use timeit to track the time of our function calls
-	json_time = timeit.Timer('test_json()', 'from __main__ import test_json, source, json_result')
-	pickle_time = timeit.Timer('test_pickle()', 'from __main__ import test_pickle, source, pickle_result')
-	json_load_time = timeit.Timer('test_json_load()', 'from __main__ import test_json_load, source, json_result')
-	pickle_load_time = timeit.Timer('test_pickle_load()', 'from __main__ import test_pickle_load, source, pickle_result')
-	
-	print "Dir\tEntries\tMethod\tTime\tLength"
-	print
-	
-	# Feel free to try 500 and 1000 but beware that they could take.. Hours!
-	for i in (10, 20, 50, 100):
-		print "dump\t%s\tJSON\t%.3f\t%s" % (i, json_time.timeit(i), len(''.join(json_result)))
-		print "load\t%s\tJSON\t%.3f\t%s" % (i, json_load_time.timeit(i), '-')
-		print "dump\t%s\tPickle\t%.3f\t%s" % (i, pickle_time.timeit(i), len(''.join(pickle_result)))
-		print "load\t%s\tPickle\t%.3f\t%s" % (i, pickle_load_time.timeit(i), '-')
-
-		# Clear the results after each run since we need to measure size.
-		json_result = []
-		pickle_result = []
+
+# name -> codec, in registration order. See register_codec().
+codecs = {}
+
+def register_codec(name, dumps, loads, module=None, version=None, binary=True, dump=None, load=None, protocol=None):
+	"""
+		Adds a serializer to the registry. dumps and loads are the only
+		required callables, the rest is metadata printed alongside the
+		results: the module the codec comes from, its version and whether
+		it produces bytes (binary) or text. dump and load are the codec's
+		own file functions if it has them, otherwise they're emulated with
+		dumps/loads and a single write/read. protocol is the pickle protocol
+		for pickle codecs, the oob mode needs 5 or higher.
+	"""
+	if version is None:
+		version = getattr(module, '__version__', None) or platform.python_version()
+
+	if dump is None:
+		dump = lambda obj, fp: fp.write(dumps(obj))
+	if load is None:
+		load = lambda fp: loads(fp.read())
+
+	codecs[name] = {
+		'name': name,
+		'dumps': dumps,
+		'loads': loads,
+		'dump': dump,
+		'load': load,
+		'module': getattr(module, '__name__', None),
+		'version': version,
+		'binary': binary,
+		'protocol': protocol,
+	}
+
+	return codecs[name]
+
+def register_default_codecs():
+	"""
+		Registers the standard library codecs plus any optional third-party
+		ones that happen to be installed.
+	"""
+	register_codec('json', json.dumps, json.loads, json, binary=False, dump=json.dump, load=json.load)
+
+	try:
+		import simplejson
+		register_codec('simplejson', simplejson.dumps, simplejson.loads, simplejson, binary=False,
+			dump=simplejson.dump, load=simplejson.load)
+	except ImportError:
+		pass
+
+	for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+		register_codec('pickle-%d' % protocol, functools.partial(pickle.dumps, protocol=protocol),
+			pickle.loads, pickle, version=pickle.format_version,
+			dump=functools.partial(pickle.dump, protocol=protocol), load=pickle.load, protocol=protocol)
+
+	register_codec('marshal', marshal.dumps, marshal.loads, marshal, version=str(marshal.version),
+		dump=marshal.dump, load=marshal.load)
+
+	try:
+		import msgpack
+		# Our nested dictionaries have int keys, msgpack refuses those by default.
+		register_codec('msgpack', msgpack.packb,
+			functools.partial(msgpack.unpackb, strict_map_key=False), msgpack,
+			dump=msgpack.pack, load=functools.partial(msgpack.unpack, strict_map_key=False))
+	except ImportError:
+		pass
+
+	try:
+		import orjson
+		register_codec('orjson', functools.partial(orjson.dumps, option=orjson.OPT_NON_STR_KEYS),
+			orjson.loads, orjson)
+	except ImportError:
+		pass
+
+	try:
+		import ujson
+		register_codec('ujson', ujson.dumps, ujson.loads, ujson, binary=False, dump=ujson.dump, load=ujson.load)
+	except ImportError:
+		pass
+
+	try:
+		import cbor2
+		register_codec('cbor', cbor2.dumps, cbor2.loads, cbor2, dump=cbor2.dump, load=cbor2.load)
+	except ImportError:
+		pass
+
+def select_codecs(patterns=None):
+	"""
+		Returns the registered codecs matching a comma-separated list of
+		shell-style patterns, e.g. "json,pickle-*". All of them if None.
+	"""
+	if not patterns:
+		return list(codecs.values())
+
+	patterns = [p.strip() for p in patterns.split(',') if p.strip()]
+	selected = [c for c in codecs.values() if any(fnmatch.fnmatchcase(c['name'], p) for p in patterns)]
+	if not selected:
+		raise SystemExit('No codecs match %r, available: %s' % (','.join(patterns), ', '.join(codecs)))
+
+	return selected
+
+def positive_int(value):
+	"""
+		argparse type for counts that must be at least 1.
+	"""
+	number = int(value)
+	if number < 1:
+		raise argparse.ArgumentTypeError('must be at least 1, got %r' % value)
+
+	return number
+
+def non_negative_int(value):
+	"""
+		argparse type for counts where 0 means off.
+	"""
+	number = int(value)
+	if number < 0:
+		raise argparse.ArgumentTypeError('must be at least 0, got %r' % value)
+
+	return number
+
+def main(argv=None):
+	# Need access to this outside our functions.
+	global source
+
+	if argv is None:
+		argv = sys.argv[1:]
+	if argv and argv[0] == 'compare':
+		return compare_main(argv[1:])
+
+	parser = argparse.ArgumentParser(description='Compare serializer speed and output size.',
+		epilog='Run "%(prog)s compare --help" to diff saved results against a baseline.')
+	parser.add_argument('--codecs', help='comma-separated codec names or patterns, e.g. "json,pickle-*"')
+	parser.add_argument('--list', action='store_true', help='list available codecs and exit')
+	parser.add_argument('--iterations', type=positive_int, default=100, help='passes over the source per timed repeat (default: 100)')
+	parser.add_argument('--repeat', type=positive_int, default=5,
+		help='timed repeats per measurement, the P95 column needs at least 20 (default: 5)')
+	parser.add_argument('--warmup', type=int, default=3, help='untimed passes before measuring (default: 3)')
+	parser.add_argument('--seed', type=int, help='random seed for reproducible source data')
+	parser.add_argument('--profile', default='lipsum', help='payload profile to benchmark on (default: lipsum)')
+	parser.add_argument('--param', action='append', default=[], metavar='KEY=VALUE',
+		help='override a profile parameter, e.g. depth=8 or str_len=5,40 (repeatable)')
+	parser.add_argument('--sample', metavar='PATH', help='synthesize look-alike data from a sample JSON document')
+	parser.add_argument('--workers', type=non_negative_int, default=0, metavar='N',
+		help='also measure aggregate throughput with 1 up to N concurrent workers')
+	parser.add_argument('--pool', choices=('process', 'thread', 'both'), default='both',
+		help='worker pool type for --workers (default: both)')
+	parser.add_argument('--modes', default='entry',
+		help='comma-separated serialization modes: entry, document, batch, oob (default: entry)')
+	parser.add_argument('--batch-size', type=positive_int, default=10, help='entries per document in batch mode (default: 10)')
+	parser.add_argument('--io', action='store_true', help='also benchmark writing to and reading from files, mmap and pipes')
+	parser.add_argument('--io-dir', metavar='DIR', help='where --io puts its temporary files (default: system temp dir)')
+	parser.add_argument('--hotpath', metavar='DIR',
+		help='profile every codec: per-shape costs, cProfile stats and a collapsed-stack file for flamegraphs go to DIR')
+	parser.add_argument('--results-dir', default='results', metavar='DIR', help='where to save JSON and CSV results (default: results)')
+	parser.add_argument('--no-save', action='store_true', help="don't save results")
+	parser.add_argument('--baseline', action='store_true', help='also store this run as the baseline for compare')
+	args = parser.parse_args(argv)
+
+	register_default_codecs()
+	register_default_profiles()
+
+	if args.list:
+		for codec in codecs.values():
+			print("%s\t%s\t%s" % (codec['name'], codec['module'], codec['version']))
+		print()
+		for profile in profiles.values():
+			print("%s\t%s" % (profile['name'], profile['description']))
+		return
+
+	selected = select_codecs(args.codecs)
+
+	modes = [mode.strip() for mode in args.modes.split(',') if mode.strip()]
+	for mode in modes:
+		if mode not in MODES:
+			raise SystemExit('Unknown mode %r, available: %s' % (mode, ', '.join(MODES)))
+
+	if args.sample:
+		profile = sample_profile(args.sample)
+	elif args.profile in profiles:
+		profile = profiles[args.profile]
+	else:
+		raise SystemExit('Unknown profile %r, available: %s' % (args.profile, ', '.join(profiles)))
+
+	profile = dict(profile, **parse_params(args.param, profile))
+	source = profile['builder'](profile, random.Random(args.seed))
+
+	# With fewer than 20 repeats the nearest-rank 95th percentile is just the maximum.
+	print("Dir\tIters\tMethod\tMode\tMin\tMedian\t%s\tLength\tPeakKB\tBlocks\tGraphKB" % ('P95' if args.repeat >= 20 else 'Max'))
+	print()
+
+	# Times are milliseconds per pass over the whole source, so dump and load
+	# are comparable with each other and across --iterations. Memory columns
+	# come from one extra pass under tracemalloc: the peak traced memory, the
+	# blocks still allocated afterwards (the output of dump, the decoded
+	# objects of load) and the size of the decoded object graph.
+	records = []
+	corpora = {}
+	for codec in selected:
+		# Not every codec can encode every payload, e.g. bytes in JSON.
+		try:
+			corpora[codec['name']] = build_corpus(codec, source)
+		except (TypeError, ValueError, OverflowError) as e:
+			print("dump\t%s\t%s\t-\tunsupported: %s" % (args.iterations, codec['name'], e))
+			records.append({'stage': 'bench', 'dir': 'dump', 'codec': codec['name'], 'error': str(e)})
+			continue
+
+		for mode in modes:
+			prepared = MODES[mode](codec, source, args.batch_size)
+			if prepared is None:
+				continue
+
+			mode_codec, entries = prepared
+			corpus = build_corpus(mode_codec, entries)
+			length = corpus_length(corpus)
+
+			stats = summarize(bench(functools.partial(test_dump, mode_codec, entries), args.iterations, args.repeat, args.warmup), args.iterations)
+			memory = measure_memory(functools.partial(build_corpus, mode_codec, entries))
+			print("dump\t%s\t%s\t%s\t%.3f\t%.3f\t%.3f\t%s\t%.1f\t%s\t%s" % (args.iterations, codec['name'], mode, stats['min'], stats['median'], stats['p95'], length,
+				memory['peak'] / 1024.0, memory['blocks'], '-'))
+			records.append(dict(stats, stage='bench', dir='dump', codec=codec['name'], mode=mode, iterations=args.iterations,
+				length=length, peak=memory['peak'], blocks=memory['blocks']))
+
+			stats = summarize(bench(functools.partial(test_load, mode_codec, corpus), args.iterations, args.repeat, args.warmup), args.iterations)
+			memory = measure_memory(functools.partial(load_corpus, mode_codec, corpus))
+			graph = graph_size(memory['result'])
+			print("load\t%s\t%s\t%s\t%.3f\t%.3f\t%.3f\t%s\t%.1f\t%s\t%.1f" % (args.iterations, codec['name'], mode, stats['min'], stats['median'], stats['p95'], '-',
+				memory['peak'] / 1024.0, memory['blocks'], graph / 1024.0))
+			records.append(dict(stats, stage='bench', dir='load', codec=codec['name'], mode=mode, iterations=args.iterations,
+				peak=memory['peak'], blocks=memory['blocks'], graph=graph))
+
+	if args.workers:
+		print()
+		print("Pool\tWorkers\tDir\tMethod\tOps/s\tMB/s\tSpeedup")
+		print()
+
+		pools = ('process', 'thread') if args.pool == 'both' else (args.pool,)
+		for pool in pools:
+			for row in test_throughput(pool, args.workers, corpora, args.iterations, args.repeat):
+				print("%s\t%s\t%s\t%s\t%.0f\t%.1f\t%.2f" % (pool, row['workers'], row['dir'], row['codec'], row['ops'], row['mb'], row['speedup']))
+				records.append(dict(row, stage='throughput', pool=pool, iterations=args.iterations))
+
+	if args.io:
+		# Pipes read while they write, so their round trip is all in Total.
+		print()
+		if reset_peak_rss() is not None:
+			print("# PeakKB: how far each stage pushed the RSS high-water mark above its starting RSS")
+		else:
+			print("# PeakKB: tracemalloc peak of one extra round trip per stage, RSS peaks can't be reset here")
+		print("Stage\tMethod\tWrite\tRead\tTotal\tBytes\tPeakKB")
+		print()
+
+		with tempfile.TemporaryDirectory(prefix='pickle_vs_json-', dir=args.io_dir) as directory:
+			for codec in selected:
+				if codec['name'] not in corpora:
+					continue
+
+				for stage in IO_STAGES:
+					row = test_io(stage, codec, os.path.join(directory, codec['name']), args.repeat)
+					print("%s\t%s\t%s\t%s\t%.3f\t%s\t%s" % (stage, codec['name'],
+						'-' if row['write'] is None else '%.3f' % row['write'],
+						'-' if row['read'] is None else '%.3f' % row['read'],
+						row['total'], row['bytes'], row['peak_rss']))
+					records.append(dict(row, stage='io', dir=stage, codec=codec['name']))
+
+	if args.hotpath:
+		os.makedirs(args.hotpath, exist_ok=True)
+
+		print()
+		print("Shape\tDir\tMethod\tMedian\tNs/item")
+		print()
+
+		rng = random.Random(args.seed)
+		shapes = dict((name, [make_shape(rng) for i in range(30)]) for name, make_shape in SHAPES.items())
+		for name, entries in shapes.items():
+			for codec in selected:
+				for row in test_shape(codec, entries, args.iterations, args.repeat, args.warmup):
+					print("%s\t%s\t%s\t%.3f\t%.1f" % (name, row['dir'], codec['name'], row['median'], row['ns']))
+					records.append(dict(row, stage='shape', shape=name, codec=codec['name'], iterations=args.iterations))
+
+		print()
+		print("Method\tDir\tShape\tTottime\tCalls\tFunction")
+		print()
+
+		# The whole source too, to see which shapes its profile resembles.
+		shapes['source'] = source
+		stacks = collections.Counter()
+		for codec in selected:
+			for row in profile_hotpath(codec, shapes, args.iterations, args.hotpath, stacks):
+				print("%s\t%s\t%s\t%.3f\t%s\t%s" % (codec['name'], row['dir'], row['shape'], row['tottime'], row['calls'], row['function']))
+
+		path = os.path.join(args.hotpath, 'hotpath.collapsed')
+		write_collapsed(stacks, path)
+		print()
+		print("Wrote %s and <codec>-<dir>-<shape>.prof files" % path)
+
+	if not args.no_save:
+		run = {'environment': environment(selected, profile, args, argv), 'records': records}
+		path = save_results(run, args.results_dir, args.baseline)
+		print()
+		print("Saved %s" % path)
 
 	return
 
-def test_json():
+def build_corpus(codec, entries):
 	"""
-		Runs the dumps JSON test.
+		Serializes every entry exactly once. The load tests read from this
+		fixed corpus, so their cost doesn't depend on how often dump ran.
 	"""
-	for entry in source:
-		json_result.append(simplejson.dumps(entry))
-	
-def test_pickle():
+	dumps = codec['dumps']
+	return [dumps(entry) for entry in entries]
+
+def load_corpus(codec, corpus):
+	"""
+		Deserializes a corpus, keeping the results around.
+	"""
+	loads = codec['loads']
+	return [loads(data) for data in corpus]
+
+def measure_memory(func):
+	"""
+		Calls func once under tracemalloc. Returns its result, the peak
+		memory allocated during the call and the number of blocks it left
+		allocated, i.e. what the result retains.
+	"""
+	# Tracing starts from nothing here, so whatever is traced by the end
+	# was allocated during the call. reset_peak() would be neater but
+	# needs Python 3.9. If tracing is already on (-X tracemalloc), its
+	# traces are cleared instead and it's left running.
+	was_tracing = tracemalloc.is_tracing()
+	if was_tracing:
+		tracemalloc.clear_traces()
+	else:
+		tracemalloc.start()
+	try:
+		result = func()
+
+		current, peak = tracemalloc.get_traced_memory()
+		after = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+	finally:
+		if not was_tracing:
+			tracemalloc.stop()
+
+	blocks = sum(stat.count for stat in after.statistics('filename'))
+	return {'result': result, 'peak': peak, 'blocks': blocks}
+
+def graph_size(obj):
+	"""
+		Approximate memory held by an object graph: sys.getsizeof() of
+		every container and value reachable from obj, each counted once,
+		plus the memory behind any buffer views in it.
+	"""
+	seen = set()
+	size = 0
+	stack = [obj]
+	while stack:
+		obj = stack.pop()
+		if id(obj) in seen:
+			continue
+
+		seen.add(id(obj))
+		size += sys.getsizeof(obj)
+		# Out-of-band pickle buffers come back as views on memory they don't own.
+		if isinstance(obj, (pickle.PickleBuffer, memoryview)):
+			size += memoryview(obj).nbytes
+		elif isinstance(obj, dict):
+			stack.extend(obj.keys())
+			stack.extend(obj.values())
+		elif isinstance(obj, (list, tuple, set, frozenset)):
+			stack.extend(obj)
+
+	return size
+
+def mode_entry(codec, entries, batch_size):
+	"""
+		One dumps call per source entry, what this script always measured.
+	"""
+	return codec, entries
+
+def mode_document(codec, entries, batch_size):
+	"""
+		The whole source as a single document.
+	"""
+	return codec, [entries]
+
+def mode_batch(codec, entries, batch_size):
+	"""
+		The source in documents of batch_size entries each.
+	"""
+	return codec, [entries[i:i + batch_size] for i in range(0, len(entries), batch_size)]
+
+def mode_oob(codec, entries, batch_size):
 	"""
-		Runs the dumps Pickle test.
+		One entry per call through pickle protocol 5 with bytes-like values
+		wrapped in PickleBuffers, so they're handed to buffer_callback
+		instead of being copied into the pickle. Only for codecs with
+		protocol 5 or higher. Note that the buffers come back as buffer
+		objects rather than their original bytes or array types.
 	"""
+	if codec['protocol'] is None or codec['protocol'] < 5:
+		return None
+
+	oob_codec = dict(codec,
+		dumps=functools.partial(oob_dumps, protocol=codec['protocol']),
+		loads=oob_loads)
+
+	return oob_codec, [wrap_buffers(entry) for entry in entries]
+
+def oob_dumps(obj, protocol=5):
+	buffers = []
+	data = pickle.dumps(obj, protocol=protocol, buffer_callback=buffers.append)
+	return data, buffers
+
+def oob_loads(payload):
+	data, buffers = payload
+	return pickle.loads(data, buffers=buffers)
+
+def wrap_buffers(obj):
+	"""
+		Copy of obj with every bytes, bytearray and array.array value
+		replaced by a PickleBuffer.
+	"""
+	if isinstance(obj, (bytes, bytearray, array.array)):
+		return pickle.PickleBuffer(obj)
+	if isinstance(obj, dict):
+		return dict((key, wrap_buffers(value)) for key, value in obj.items())
+	if isinstance(obj, list):
+		return [wrap_buffers(value) for value in obj]
+	if isinstance(obj, tuple):
+		return tuple(wrap_buffers(value) for value in obj)
+
+	return obj
+
+def corpus_length(corpus):
+	"""
+		Total payload size, out-of-band buffers included.
+	"""
+	length = 0
+	for data in corpus:
+		if isinstance(data, tuple):
+			data, buffers = data
+			length += sum(memoryview(buffer).nbytes for buffer in buffers)
+		length += len(data)
+
+	return length
+
+# Mode name -> function(codec, entries, batch_size) returning the codec and
+# the list of objects to serialize, or None if the codec can't do the mode.
+MODES = {
+	'entry': mode_entry,
+	'document': mode_document,
+	'batch': mode_batch,
+	'oob': mode_oob,
+}
+
+def bench(func, number, repeat, warmup=0):
+	"""
+		Calls func number times per repeat, returns the total seconds taken
+		by each repeat. The warmup calls aren't timed.
+	"""
+	timer = timeit.Timer(func)
+	if warmup:
+		timer.timeit(warmup)
+
+	return timer.repeat(repeat, number)
+
+def summarize(timings, number=1):
+	"""
+		Turns raw repeat timings into min, median and 95th percentile
+		milliseconds per call. The per-call timings are kept as well, compare
+		needs them.
+	"""
+	per_call = sorted(t * 1000.0 / number for t in timings)
+	return {
+		'min': per_call[0],
+		'median': statistics.median(per_call),
+		'p95': percentile(per_call, 95),
+		'timings': per_call,
+	}
+
+def percentile(values, pct):
+	"""
+		Nearest-rank percentile of an already sorted list.
+	"""
+	rank = int(math.ceil(pct / 100.0 * len(values)))
+	return values[max(rank, 1) - 1]
+
+def test_throughput(pool, workers, corpora, iterations, repeat):
+	"""
+		Runs the dump and load tests on 1, 2, 4 .. workers concurrent
+		workers at once and yields the aggregate throughput of each step
+		for every codec in corpora, plus the speedup over a single worker.
+		The process pool shows how codecs scale across cores, the thread
+		pool how much of their time they hold the GIL.
+	"""
+	steps = []
+	n = 1
+	while n < workers:
+		steps.append(n)
+		n *= 2
+	steps.append(workers)
+
+	executor_class = ProcessPoolExecutor if pool == 'process' else ThreadPoolExecutor
+	baseline = {}
+	for n in steps:
+		with executor_class(max_workers=n, initializer=_pool_init, initargs=(source, corpora)) as executor:
+			for name, corpus in corpora.items():
+				size = sum(map(len, corpus))
+				for direction in ('dump', 'load'):
+					# Makes sure every worker is up and has run the code before we time it.
+					list(executor.map(_pool_task, [name] * n, [direction] * n, [1] * n))
+
+					walls = []
+					for i in range(repeat):
+						start = time.perf_counter()
+						futures = [executor.submit(_pool_task, name, direction, iterations) for w in range(n)]
+						for future in futures:
+							future.result()
+						walls.append(time.perf_counter() - start)
+
+					wall = statistics.median(walls)
+					ops = n * iterations * len(corpus) / wall
+					baseline.setdefault((name, direction), ops)
+					yield {
+						'workers': n,
+						'dir': direction,
+						'codec': name,
+						'ops': ops,
+						'mb': n * iterations * size / wall / 1024 / 1024,
+						'speedup': ops / baseline[(name, direction)],
+						'timings': [w * 1000.0 for w in walls],
+					}
+
+# Per-worker corpora for the load tests, see _pool_init().
+_pool_corpora = {}
+
+def _pool_init(entries, corpora):
+	"""
+		Sets up a pool worker. Forked processes inherit all of this already,
+		spawned ones start with an empty module and need it passed in.
+	"""
+	global source
+	source = entries
+	_pool_corpora.update(corpora)
+
+	if not codecs:
+		register_default_codecs()
+
+def _pool_task(name, direction, iterations):
+	"""
+		Runs a codec's dump or load test iterations times in a pool worker.
+	"""
+	codec = codecs[name]
+	if direction == 'dump':
+		func = functools.partial(test_dump, codec)
+	else:
+		func = functools.partial(test_load, codec, _pool_corpora[name])
+
+	for i in range(iterations):
+		func()
+
+def test_io(stage, codec, path, repeat):
+	"""
+		Writes the whole source through one of the IO_STAGES and reads it
+		back, repeat times. Returns median write, read and end-to-end
+		milliseconds, the number of bytes that went through and the stage's
+		peak memory in KB, see reset_peak_rss(). Stages without a separate
+		read step get None for write and read, only their total means much.
+	"""
+	write, read = IO_STAGES[stage]
+	start_rss = reset_peak_rss()
+	timings = []
+	for i in range(repeat):
+		start = time.perf_counter()
+		size = write(codec, path)
+		middle = time.perf_counter()
+		if read is not None:
+			read(codec, path)
+		end = time.perf_counter()
+		timings.append((middle - start, end - middle, end - start))
+
+	if start_rss is not None:
+		peak = proc_status_kb('VmHWM') - start_rss
+	else:
+		peak = measure_memory(lambda: (write(codec, path), read and read(codec, path)))['peak'] // 1024
+
+	write_time, read_time, total = (statistics.median(t) * 1000.0 for t in zip(*timings))
+	if read is None:
+		write_time = read_time = None
+	return {'write': write_time, 'read': read_time, 'total': total, 'bytes': size, 'peak_rss': peak,
+		'timings': [t[2] * 1000.0 for t in timings]}
+
+def to_bytes(data):
+	"""
+		Text codecs give us str, files and frames want bytes.
+	"""
+	return data.encode('utf-8') if isinstance(data, str) else data
+
+def write_file(codec, path):
+	"""
+		The whole source as one document via the codec's own dump().
+	"""
+	if codec['binary']:
+		f = open(path, 'wb')
+	else:
+		f = open(path, 'w', encoding='utf-8')
+
+	with f:
+		codec['dump'](source, f)
+
+	return os.path.getsize(path)
+
+def read_file(codec, path):
+	if codec['binary']:
+		f = open(path, 'rb')
+	else:
+		f = open(path, encoding='utf-8')
+
+	with f:
+		return codec['load'](f)
+
+# Frames are a little-endian 32 bit payload length followed by the payload.
+FRAME_HEADER = struct.Struct('<I')
+
+def write_frames(codec, f):
+	"""
+		Writes every source entry as a separate length-prefixed frame.
+		Returns the number of bytes written.
+	"""
+	dumps = codec['dumps']
+	pack = FRAME_HEADER.pack
+	written = 0
 	for entry in source:
-		pickle_result.append(pickle.dumps(entry))
-		
-def test_json_load():
+		data = to_bytes(dumps(entry))
+		f.write(pack(len(data)))
+		f.write(data)
+		written += FRAME_HEADER.size + len(data)
+
+	return written
+
+def read_frames(f):
+	"""
+		Yields frame payloads from a file-like object until EOF.
+	"""
+	unpack = FRAME_HEADER.unpack
+	while True:
+		header = f.read(FRAME_HEADER.size)
+		if len(header) < FRAME_HEADER.size:
+			return
+
+		size, = unpack(header)
+		yield f.read(size)
+
+def write_framed(codec, path):
+	with open(path, 'wb') as f:
+		return write_frames(codec, f)
+
+def read_framed(codec, path):
+	loads = codec['loads']
+	with open(path, 'rb') as f:
+		for data in read_frames(f):
+			loads(data)
+
+def read_mmap_frames(m):
+	"""
+		Yields frame payloads straight out of a memory-mapped file.
+	"""
+	unpack_from = FRAME_HEADER.unpack_from
+	offset = 0
+	end = len(m)
+	while offset < end:
+		size, = unpack_from(m, offset)
+		offset += FRAME_HEADER.size
+		yield m[offset:offset + size]
+		offset += size
+
+def read_mmap(codec, path):
+	# Empty files can't be mapped.
+	if not os.path.getsize(path):
+		return
+
+	loads = codec['loads']
+	with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+		for data in read_mmap_frames(m):
+			loads(data)
+
+def write_pipe(codec, path):
+	"""
+		Frames have to be read while they're written or the pipe fills up,
+		so for pipes the write stage does the whole round trip and there's
+		no read stage. Only the total is meaningful.
+	"""
+	r, w = os.pipe()
+	loads = codec['loads']
+	written = []
+	with os.fdopen(r, 'rb') as reader:
+		writer = threading.Thread(target=_write_pipe, args=(codec, w, written))
+		writer.start()
+		for data in read_frames(reader):
+			loads(data)
+		writer.join()
+
+	return written[0]
+
+def _write_pipe(codec, fd, written):
+	with os.fdopen(fd, 'wb') as f:
+		written.append(write_frames(codec, f))
+
+# Stage name -> (write(codec, path) returning bytes written, read(codec, path)).
+# mmap reads the framed file, so it's written the same way. Pipes have no
+# read step of their own, see write_pipe().
+IO_STAGES = {
+	'file': (write_file, read_file),
+	'framed': (write_framed, read_framed),
+	'mmap': (write_framed, read_mmap),
+	'pipe': (write_pipe, None),
+}
+
+def reset_peak_rss():
+	"""
+		Resets this process's RSS high-water mark (VmHWM) to its current RSS
+		so the next stage's peak can be read back on its own. Returns the
+		current RSS in KB, None where that isn't possible (not Linux).
+	"""
+	try:
+		with open('/proc/self/clear_refs', 'w') as f:
+			f.write('5')
+		return proc_status_kb('VmRSS')
+	except OSError:
+		return None
+
+def proc_status_kb(field):
+	"""
+		A KB value such as VmRSS or VmHWM from /proc/self/status.
+	"""
+	with open('/proc/self/status') as f:
+		for line in f:
+			if line.startswith(field + ':'):
+				return int(line.split()[1])
+
+	raise OSError('No %s in /proc/self/status' % field)
+
+def environment(selected, profile, args, argv):
+	"""
+		Everything about this run that could explain a change in results:
+		interpreter, machine, codec versions, the payload it ran on and the
+		arguments main() was given.
+	"""
+	return {
+		'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+		'argv': list(argv),
+		'python': platform.python_version(),
+		'implementation': platform.python_implementation(),
+		'compiler': platform.python_compiler(),
+		'platform': platform.platform(),
+		'machine': platform.machine(),
+		'cpu': cpu_model(),
+		'cpu_count': os.cpu_count(),
+		'codecs': dict((codec['name'], {'module': codec['module'], 'version': str(codec['version'])}) for codec in selected),
+		'profile': dict((key, value) for key, value in profile.items() if key != 'builder'),
+		'seed': args.seed,
+		'iterations': args.iterations,
+		'repeat': args.repeat,
+		'warmup': args.warmup,
+	}
+
+def cpu_model():
+	"""
+		platform.processor() is empty or just "x86_64" on most Linux boxes,
+		/proc/cpuinfo has the actual model name.
+	"""
+	try:
+		with open('/proc/cpuinfo') as f:
+			for line in f:
+				if line.startswith('model name'):
+					return line.split(':', 1)[1].strip()
+	except OSError:
+		pass
+
+	return platform.processor() or platform.machine()
+
+# Record fields in the order they go into CSV files.
+CSV_FIELDS = (
+	'stage', 'pool', 'workers', 'shape', 'dir', 'codec', 'mode', 'iterations',
+	'min', 'median', 'p95', 'length', 'peak', 'blocks', 'graph',
+	'ops', 'mb', 'speedup', 'write', 'read', 'total', 'bytes', 'peak_rss', 'ns',
+	'error', 'timings',
+)
+
+def save_results(run, directory, baseline=False):
+	"""
+		Writes a run to <directory>/<timestamp>-<profile>.json, plus a CSV
+		with one line per record, and to baseline.json if asked to. Returns
+		the JSON path.
+	"""
+	os.makedirs(directory, exist_ok=True)
+
+	# Microseconds, so quick successive runs don't overwrite each other.
+	name = '%s-%s' % (datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f'), run['environment']['profile']['name'])
+	path = os.path.join(directory, name + '.json')
+	with open(path, 'w') as f:
+		json.dump(run, f, indent=1, default=repr)
+
+	with open(os.path.join(directory, name + '.csv'), 'w', newline='') as f:
+		writer = csv.DictWriter(f, CSV_FIELDS, extrasaction='ignore')
+		writer.writeheader()
+		for record in run['records']:
+			record = dict(record)
+			if 'timings' in record:
+				record['timings'] = ' '.join('%.6f' % t for t in record['timings'])
+			writer.writerow(record)
+
+	if baseline:
+		shutil.copyfile(path, os.path.join(directory, 'baseline.json'))
+
+	return path
+
+def compare_main(argv):
+	"""
+		The compare command: diffs a saved run against a baseline and exits
+		with status 1 if anything got significantly slower, so it can gate
+		interpreter and library upgrades in CI.
+	"""
+	parser = argparse.ArgumentParser(prog='pickle_vs_json.py compare',
+		description='Compare a saved run against a baseline and flag significant slowdowns.')
+	parser.add_argument('run', nargs='?', help='results JSON to check (default: the latest in --results-dir)')
+	parser.add_argument('--baseline', help='baseline results JSON (default: baseline.json in --results-dir)')
+	parser.add_argument('--results-dir', default='results', metavar='DIR', help='where results are saved (default: results)')
+	parser.add_argument('--alpha', type=float, default=0.05, help='significance level (default: 0.05)')
+	parser.add_argument('--threshold', type=float, default=5.0, help='ignore changes smaller than this many percent (default: 5)')
+	args = parser.parse_args(argv)
+
+	baseline_path = args.baseline or os.path.join(args.results_dir, 'baseline.json')
+	run_path = args.run or latest_results(args.results_dir)
+	if not run_path:
+		raise SystemExit('No results in %s, run a benchmark first' % args.results_dir)
+
+	if not os.path.exists(baseline_path):
+		raise SystemExit('No baseline at %s, store one by running a benchmark with --baseline or pass --baseline PATH' % baseline_path)
+
+	baseline = load_results(baseline_path)
+	run = load_results(run_path)
+
+	print("Baseline: %s" % baseline_path)
+	print("Run: %s" % run_path)
+	for key in ('python', 'implementation', 'cpu', 'codecs', 'profile', 'iterations'):
+		if baseline['environment'].get(key) != run['environment'].get(key):
+			print("Note: %s differs: %s -> %s" % (key, baseline['environment'].get(key), run['environment'].get(key)))
+	print()
+
+	print("Stage\tDir\tMethod\tBase\tRun\tChange\tP\tFlag")
+	print()
+
+	rows = compare_runs(baseline['records'], run['records'], args.alpha, args.threshold)
+	for row in rows:
+		print("%s\t%s\t%s\t%.3f\t%.3f\t%+.1f%%\t%.3f\t%s" % (row['stage'], row['dir'], row['codec'],
+			row['base'], row['run'], row['change'], row['p'], row['flag']))
+
+	slower = [row for row in rows if row['flag'] == 'SLOWER']
+	print()
+	print("%d of %d measurements significantly slower" % (len(slower), len(rows)))
+
+	return 1 if slower else 0
+
+def load_results(path):
+	"""
+		Reads a run saved by save_results(), exiting with a message if the
+		file isn't one.
+	"""
+	try:
+		with open(path) as f:
+			run = json.load(f)
+	except OSError as e:
+		raise SystemExit('Cannot read %s: %s' % (path, e))
+	except ValueError as e:
+		raise SystemExit('%s is not valid JSON: %s' % (path, e))
+
+	if not isinstance(run, dict) or not isinstance(run.get('environment'), dict) or not isinstance(run.get('records'), list):
+		raise SystemExit('%s is not a pickle_vs_json results file, it has no environment and records' % path)
+
+	return run
+
+def latest_results(directory):
+	"""
+		Newest saved run in a results directory, not counting the baseline.
+	"""
+	paths = glob.glob(os.path.join(directory, '*.json'))
+	paths = [path for path in paths if os.path.basename(path) != 'baseline.json']
+
+	return max(paths, key=os.path.getmtime) if paths else None
+
+def record_key(record):
+	"""
+		What a record measured, so it can be matched up across runs.
+	"""
+	stage = record['stage']
+	if record.get('pool'):
+		stage = '%s/%s/%s' % (stage, record['pool'], record['workers'])
+	if record.get('mode', 'entry') != 'entry':
+		stage = '%s/%s' % (stage, record['mode'])
+	if record.get('shape'):
+		stage = '%s/%s' % (stage, record['shape'])
+
+	return (stage, record['dir'], record['codec'])
+
+def compare_runs(baseline, run, alpha, threshold):
+	"""
+		Matches up records with timings in two runs. A measurement is
+		flagged SLOWER (or faster) when its median moved by more than
+		threshold percent and a one-sided Mann-Whitney U test on the
+		repeat timings says that's unlikely to be noise.
+	"""
+	before = dict((record_key(record), record) for record in baseline if record.get('timings'))
+	rows = []
+	for record in run:
+		key = record_key(record)
+		if not record.get('timings') or key not in before:
+			continue
+
+		old = before[key]['timings']
+		new = record['timings']
+		base = statistics.median(old)
+		median = statistics.median(new)
+		change = (median - base) / base * 100.0 if base else 0.0
+
+		# Test in the direction the median moved.
+		p = mann_whitney(old, new) if change >= 0 else mann_whitney(new, old)
+		flag = ''
+		if abs(change) > threshold and p < alpha:
+			flag = 'SLOWER' if change > 0 else 'faster'
+
+		rows.append({'stage': key[0], 'dir': key[1], 'codec': key[2], 'base': base, 'run': median,
+			'change': change, 'p': p, 'flag': flag})
+
+	return rows
+
+def mann_whitney(a, b):
+	"""
+		One-sided Mann-Whitney U test: the p-value for values in b tending
+		to be larger than those in a. Uses the normal approximation with a
+		tie correction, which is fine for the handful of repeats we have.
+	"""
+	n1, n2 = len(a), len(b)
+	values = sorted([(value, 0) for value in a] + [(value, 1) for value in b])
+
+	# Average ranks over ties.
+	ranks = [0.0] * len(values)
+	ties = 0.0
+	i = 0
+	while i < len(values):
+		j = i
+		while j + 1 < len(values) and values[j + 1][0] == values[i][0]:
+			j += 1
+		for k in range(i, j + 1):
+			ranks[k] = (i + j) / 2.0 + 1
+		ties += (j - i + 1) ** 3 - (j - i + 1)
+		i = j + 1
+
+	n = n1 + n2
+	u = sum(rank for rank, (value, group) in zip(ranks, values) if group) - n2 * (n2 + 1) / 2.0
+	sigma = math.sqrt(n1 * n2 / 12.0 * ((n + 1) - ties / (n * (n - 1))))
+	if not sigma:
+		return 1.0
+
+	z = (u - n1 * n2 / 2.0 - 0.5) / sigma
+	return 1.0 - statistics.NormalDist().cdf(z)
+
+def test_shape(codec, entries, iterations, repeat, warmup):
 	"""
-		Runs the loads JSON test.
+		Times a codec on one of the SHAPES. Yields median milliseconds per
+		pass for dump and load, and nanoseconds per item, every key, value
+		and container counting as one.
 	"""
-	for entry in json_result:
-		simplejson.loads(entry)
-		
-def test_pickle_load():
+	try:
+		corpus = build_corpus(codec, entries)
+	except (TypeError, ValueError, OverflowError):
+		return
+
+	items = sum(map(count_items, entries))
+	for direction, func in (('dump', functools.partial(test_dump, codec, entries)), ('load', functools.partial(test_load, codec, corpus))):
+		stats = summarize(bench(func, iterations, repeat, warmup), iterations)
+		yield dict(stats, dir=direction, ns=stats['median'] * 1e6 / items)
+
+def count_items(obj):
+	if isinstance(obj, dict):
+		return 1 + len(obj) + sum(map(count_items, obj.values()))
+	if isinstance(obj, (list, tuple)):
+		return 1 + sum(map(count_items, obj))
+
+	return 1
+
+def shape_strings(rng):
+	return [lipsum(3, rng) for i in range(50)]
+
+def shape_str_keys(rng):
+	return dict(('%s_%d' % (lipsum(1, rng), i), i) for i in range(50))
+
+def shape_int_keys(rng):
+	return dict((i, lipsum(10, rng)) for i in range(50))
+
+def shape_ints(rng):
+	return [rng.randint(-2 ** 31, 2 ** 31 - 1) for i in range(50)]
+
+def shape_floats(rng):
+	return [rng.uniform(-1e6, 1e6) for i in range(50)]
+
+def shape_escapes(rng):
+	return [lipsum(3, rng) + ' "quoted" \\ back\tslash\n' + unicode_text(2, rng) for i in range(50)]
+
+def shape_deep(rng):
+	obj = lipsum(1, rng)
+	for i in range(50):
+		obj = {i: obj}
+
+	return obj
+
+# Shape name -> function(rng) returning one object of an isolated shape from
+# get_data(), so the cost of each can be told apart.
+SHAPES = {
+	'strings': shape_strings,    # flat list of short strings
+	'str-keys': shape_str_keys,  # dict cost dominated by string keys
+	'int-keys': shape_int_keys,  # int-keyed dict of longer string values
+	'ints': shape_ints,
+	'floats': shape_floats,
+	'escapes': shape_escapes,    # strings needing quoting and unicode escapes
+	'deep': shape_deep,          # recursion: 50 levels of single-key dicts
+}
+
+def profile_hotpath(codec, shapes, iterations, directory, stacks):
 	"""
-		Runs the loads Pickle test.
+		Runs a codec's dump and load tests on each of shapes (name -> list
+		of entries) under cProfile, saving the stats to
+		<directory>/<codec>-<dir>-<shape>.prof, and then again under the
+		stack sampler, adding its samples to stacks as codec;dir;shape;...
+		Yields the top HOTPATH_TOP functions by own time for each direction
+		and shape, leaving out this script's own functions.
 	"""
-	for entry in pickle_result:
-		pickle.loads(entry)
+	dumps, dumps_name = native_call(codec['dumps'])
+	loads, loads_name = native_call(codec['loads'])
+	native = dict(codec, dumps=dumps, loads=loads)
+
+	for shape, entries in shapes.items():
+		try:
+			corpus = build_corpus(codec, entries)
+		except (TypeError, ValueError, OverflowError):
+			continue
+
+		tests = (
+			('dump', functools.partial(test_dump, native, entries), dumps_name),
+			('load', functools.partial(test_load, native, corpus), loads_name),
+		)
+		for direction, func, name in tests:
+			profiler = cProfile.Profile()
+			profiler.enable()
+			for i in range(iterations):
+				func()
+			profiler.disable()
+			profiler.dump_stats(os.path.join(directory, '%s-%s-%s.prof' % (codec['name'], direction, shape)))
+
+			# Leave out this script's own loops and wrappers, they're not the codec's cost.
+			stats = pstats.Stats(profiler).stats
+			stats.pop(('~', 0, "<method 'disable' of '_lsprof.Profiler' objects>"), None)
+			stats = dict((function, stat) for function, stat in stats.items() if function[0] != test_dump.__code__.co_filename)
+			top = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:HOTPATH_TOP]
+			for function, (primitive, calls, tottime, cumtime, callers) in top:
+				yield {'dir': direction, 'shape': shape, 'tottime': tottime, 'calls': calls, 'function': pstats.func_std_string(function)}
+
+			for stack, count in sample_stacks(func, iterations, leaf=(_native_call_code, name)).items():
+				stacks[(codec['name'], direction, shape) + stack] += count
 
-def get_data(count):
+def native_call(func):
+	"""
+		Wraps func in a plain Python function, with any functools.partial
+		unpacked, so the C function underneath is called straight from
+		Python code. cProfile doesn't see C functions called by a partial.
+		Returns the wrapper and the wrapped function's name.
+	"""
+	args = ()
+	keywords = {}
+	if isinstance(func, functools.partial):
+		func, args, keywords = func.func, func.args, func.keywords
+
+	def call(obj):
+		return func(*(args + (obj,)), **keywords)
+
+	name = '%s.%s' % (getattr(func, '__module__', None) or '?', getattr(func, '__qualname__', repr(func)))
+	return call, name
+
+# Every wrapper native_call() returns shares this code object, so the
+# sampler can tell when it's sitting in one.
+_native_call_code = native_call(len)[0].__code__
+
+# How many functions profile_hotpath() reports per codec, direction and shape.
+# The full stats are in the .prof files.
+HOTPATH_TOP = 5
+
+# Seconds between stack samples, and the least time to sample each test for.
+SAMPLE_INTERVAL = 0.0005
+SAMPLE_TIME = 0.1
+
+def sample_stacks(func, iterations, interval=SAMPLE_INTERVAL, leaf=None):
+	"""
+		Calls func iterations times, and more until SAMPLE_TIME has passed,
+		while a background thread samples this thread's stack. Returns a
+		Counter of stacks (tuples of frame names, outermost first) below
+		this function. C functions have no frames, so their time shows up
+		in the Python frame calling them; leaf=(code, name) adds name as a
+		frame whenever the innermost frame runs that code, which is how
+		native_call() wrappers get their C function named.
+		The sampler needs the GIL to take a sample, so the switch interval
+		is lowered to the sampling interval meanwhile.
+	"""
+	ident = threading.get_ident()
+	running = threading.Event()
+	done = threading.Event()
+	counts = collections.Counter()
+
+	def sampler():
+		running.wait()
+		while not done.is_set():
+			frame = sys._current_frames().get(ident)
+			stack = []
+			if frame is not None and leaf and frame.f_code is leaf[0]:
+				stack.append(leaf[1])
+			while frame is not None and frame.f_code is not sample_stacks.__code__:
+				code = frame.f_code
+				stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+				frame = frame.f_back
+			if frame is not None and stack:
+				counts[tuple(reversed(stack))] += 1
+			done.wait(interval)
+
+	switch_interval = sys.getswitchinterval()
+	thread = threading.Thread(target=sampler, daemon=True)
+	thread.start()
+	sys.setswitchinterval(interval)
+	try:
+		running.set()
+		start = time.perf_counter()
+		done_iterations = 0
+		while done_iterations < iterations or time.perf_counter() - start < SAMPLE_TIME:
+			func()
+			done_iterations += 1
+	finally:
+		done.set()
+		sys.setswitchinterval(switch_interval)
+		thread.join()
+
+	return counts
+
+def write_collapsed(stacks, path):
+	"""
+		Writes stacks in the collapsed format flamegraph.pl, speedscope
+		and friends read: "frame;frame;frame count" per line.
+	"""
+	with open(path, 'w') as f:
+		for stack, count in sorted(stacks.items()):
+			f.write('%s %d\n' % (';'.join(frame.replace(';', ':') for frame in stack), count))
+
+def test_dump(codec, entries=None):
+	"""
+		Runs the dumps test for the given codec, on the source unless
+		given other entries.
+	"""
+	dumps = codec['dumps']
+	for entry in source if entries is None else entries:
+		dumps(entry)
+
+def test_load(codec, corpus):
+	"""
+		Runs the loads test for the given codec.
+	"""
+	loads = codec['loads']
+	for entry in corpus:
+		loads(entry)
+
+def get_data(count, rng=random):
 	"""
 		Use this function to generate data, returns a touple containing
-		a list, a dictionary and a nested dictionary.
+		a list, a dictionary and a nested dictionary. Pass a seeded
+		random.Random as rng for reproducible data.
 	"""
 	l = []; d = {}; nd = {};
 	for i in range(count):
-		d[lipsum(1)] = lipsum(10)
-		l.append(lipsum(3))
-		nd[lipsum(1)] = {i: lipsum(1), i+1: [lipsum(2), lipsum(4), lipsum(3)], i+2: {i: lipsum(3), i+1: lipsum(4), i+2: [lipsum(2), lipsum(3)]}}
+		d[lipsum(1, rng)] = lipsum(10, rng)
+		l.append(lipsum(3, rng))
+		nd[lipsum(1, rng)] = {i: lipsum(1, rng), i+1: [lipsum(2, rng), lipsum(4, rng), lipsum(3, rng)], i+2: {i: lipsum(3, rng), i+1: lipsum(4, rng), i+2: [lipsum(2, rng), lipsum(3, rng)]}}
 
 	return l, d, nd
 
-def lipsum(count=50):
+# Default parameters for make_payload(), every profile overrides some of them.
+PROFILE_DEFAULTS = {
+	'entries': 30,          # top-level objects in the source
+	'shape': 'dict',        # top-level object: dict, list or records (a list of same-keyed dicts)
+	'length': 100,          # items in a top-level list or records object
+	'fanout': 10,           # keys or items per dict and nested list
+	'depth': 2,             # how many levels of containers may appear below the top-level object
+	'nesting': 0.3,         # chance of a value being a container while above depth
+	'types': {'str': 1},    # leaf value type -> weight, see LEAF_TYPES
+	'str_len': (1, 10),     # words per string, min and max
+	'str_dist': 'uniform',  # uniform or lognormal (mostly short, a few long ones)
+	'bytes_len': (16, 256), # bytes per blob or array, min and max
+	'int_keys': False,      # int keys 0..fanout instead of words
+	'size': None,           # lipsum only: fill the source with this many bytes of phrase lists instead
+}
+
+# name -> profile, see register_profile().
+profiles = {}
+
+def register_profile(name, description, builder=None, accepts=None, **params):
+	"""
+		Adds a named payload profile. By default the source is built by
+		make_payload() from params overriding PROFILE_DEFAULTS, pass a
+		builder(profile, rng) returning a list of entries to do it yourself.
+		accepts lists the parameters the builder actually uses, --param
+		rejects the rest. make_payload() uses all of them but size.
+	"""
+	unknown = set(params) - set(PROFILE_DEFAULTS)
+	if unknown:
+		raise ValueError('Unknown profile parameters: %s' % ', '.join(sorted(unknown)))
+
+	for key, value in params.items():
+		check_param(key, value)
+
+	if accepts is None:
+		accepts = [key for key in PROFILE_DEFAULTS if builder or key != 'size']
+
+	profile = dict(PROFILE_DEFAULTS, name=name, description=description, builder=builder or make_payload, accepts=tuple(accepts))
+	profile.update(params)
+	profiles[name] = profile
+
+	return profile
+
+def register_default_profiles():
+	"""
+		Registers the built-in payload profiles. Rankings tend to flip between
+		them, so benchmark on whichever looks most like your data.
+	"""
+	register_profile('lipsum', 'the original lists, dicts and nested int-keyed dicts of lorem ipsum strings',
+		builder=lipsum_source, accepts=('entries', 'fanout', 'size'), fanout=50)
+	register_profile('wide', 'flat records with 200 fields of mixed scalars',
+		depth=0, fanout=200, types={'str': 4, 'int': 3, 'float': 2, 'bool': 1, 'none': 1})
+	register_profile('numeric', 'long lists of floats, ints and large ints',
+		shape='list', length=1000, depth=0, types={'float': 5, 'int': 3, 'bigint': 2})
+	register_profile('blobs', 'dicts of binary blobs from 1KB to 64KB',
+		depth=0, types={'bytes': 4, 'str': 1}, bytes_len=(1024, 65536))
+	register_profile('deep', 'narrow, deeply nested dicts and lists',
+		depth=16, fanout=3, nesting=0.45, types={'str': 2, 'int': 1})
+	register_profile('records', 'long lists of small dicts sharing the same keys, like database rows',
+		shape='records', length=200, fanout=8, depth=0, types={'str': 3, 'int': 3, 'float': 1, 'bool': 1, 'none': 1})
+	register_profile('unicode', 'dicts of long non-ASCII strings',
+		depth=1, types={'unicode': 4, 'str': 1}, str_len=(5, 200), str_dist='lognormal')
+
+def parse_params(items, profile):
+	"""
+		Turns ["depth=8", "str_len=5,40"] into parameters for profile. Values
+		are Python literals where possible, plain strings otherwise.
+	"""
+	params = {}
+	for item in items:
+		key, sep, value = item.partition('=')
+		if not sep or key not in PROFILE_DEFAULTS:
+			raise SystemExit('Bad profile parameter %r, expected KEY=VALUE with KEY one of: %s' % (item, ', '.join(PROFILE_DEFAULTS)))
+		if key not in profile['accepts']:
+			raise SystemExit('The %s profile ignores %s, it takes: %s' % (profile['name'], key, ', '.join(profile['accepts'])))
+
+		try:
+			params[key] = ast.literal_eval(value)
+		except (ValueError, SyntaxError):
+			params[key] = value
+
+		try:
+			check_param(key, params[key])
+		except ValueError as e:
+			raise SystemExit('Bad profile parameter %r: %s' % (item, e))
+
+	return params
+
+def check_param(key, value):
+	"""
+		Raises ValueError if value doesn't make sense for a profile parameter.
+	"""
+	def is_int(value):
+		return isinstance(value, int) and not isinstance(value, bool)
+
+	if key in ('entries', 'length', 'fanout'):
+		if not is_int(value) or value < 1:
+			raise ValueError('expected an int of at least 1')
+	elif key == 'depth':
+		if not is_int(value) or value < 0:
+			raise ValueError('expected an int of at least 0')
+	elif key == 'nesting':
+		if not isinstance(value, (int, float)) or isinstance(value, bool) or not 0 <= value <= 1:
+			raise ValueError('expected a number between 0 and 1')
+	elif key == 'shape':
+		if value not in ('dict', 'list', 'records'):
+			raise ValueError('expected dict, list or records')
+	elif key == 'str_dist':
+		if value not in ('uniform', 'lognormal'):
+			raise ValueError('expected uniform or lognormal')
+	elif key in ('str_len', 'bytes_len'):
+		if not isinstance(value, (tuple, list)) or len(value) != 2 or not all(map(is_int, value)) or not 0 <= value[0] <= value[1]:
+			raise ValueError('expected min,max ints with 0 <= min <= max')
+	elif key == 'types':
+		if not isinstance(value, dict) or not value:
+			raise ValueError('expected a dict of leaf type -> weight, e.g. {"str": 2, "int": 1}')
+		unknown = set(value) - set(LEAF_TYPES)
+		if unknown:
+			raise ValueError('unknown leaf types %s, available: %s' % (', '.join(sorted(map(str, unknown))), ', '.join(LEAF_TYPES)))
+		if not all(isinstance(weight, (int, float)) and weight >= 0 for weight in value.values()) or not sum(value.values()):
+			raise ValueError('weights must be non-negative numbers, not all zero')
+	elif key == 'int_keys':
+		if not isinstance(value, bool):
+			raise ValueError('expected True or False')
+	elif key == 'size':
+		if value is not None and (not isinstance(value, (int, float)) or isinstance(value, bool) or value <= 0):
+			raise ValueError('expected a positive number of bytes')
+
+def lipsum_source(profile, rng):
+	"""
+		The source this script always used: get_data() triplets. With a
+		size it's lists of fanout 3-word phrases, like get_data()'s list,
+		until the phrases add up to size bytes, e.g. --param size=100e6.
+	"""
+	if profile['size']:
+		phrases = lipsum_phrases(3, size=int(profile['size']), rng=rng)
+		entries = []
+		while True:
+			entry = list(itertools.islice(phrases, profile['fanout']))
+			if not entry:
+				return entries
+			entries.append(entry)
+
+	entries = []
+	for i in range(int(math.ceil(profile['entries'] / 3.0))):
+		entries.extend(get_data(profile['fanout'], rng))
+
+	return entries[:profile['entries']]
+
+def make_payload(profile, rng):
+	"""
+		Builds the list of source entries described by a profile.
+	"""
+	return [make_entry(profile, rng) for i in range(profile['entries'])]
+
+def make_entry(profile, rng):
+	"""
+		Builds one top-level object according to the profile's shape.
+	"""
+	shape = profile['shape']
+	if shape == 'dict':
+		return make_dict(profile, 1, rng)
+	if shape == 'list':
+		return [make_value(profile, 1, rng) for i in range(profile['length'])]
+	if shape == 'records':
+		keys = make_keys(profile, rng)
+		return [dict((key, make_value(profile, 1, rng)) for key in keys) for i in range(profile['length'])]
+
+	raise ValueError('Unknown profile shape %r' % shape)
+
+def make_dict(profile, level, rng):
+	return dict((key, make_value(profile, level, rng)) for key in make_keys(profile, rng))
+
+def make_keys(profile, rng):
+	if profile['int_keys']:
+		return list(range(profile['fanout']))
+
+	# The index keeps keys unique so wide records really are fanout wide.
+	words = lipsum_words()
+	return ['%s_%d' % (rng.choice(words).strip('.,').lower(), i) for i in range(profile['fanout'])]
+
+def make_value(profile, level, rng):
+	"""
+		Returns a container while we're above the profile's depth and the
+		nesting dice say so, a leaf value otherwise.
+	"""
+	if level <= profile['depth'] and rng.random() < profile['nesting']:
+		if rng.random() < 0.5:
+			return make_dict(profile, level + 1, rng)
+		return [make_value(profile, level + 1, rng) for i in range(profile['fanout'])]
+
+	types = profile['types']
+	kind = rng.choices(list(types), list(types.values()))[0]
+	return LEAF_TYPES[kind](profile, rng)
+
+def string_length(profile, rng):
+	low, high = profile['str_len']
+	if profile['str_dist'] == 'lognormal':
+		return min(high, low + int(rng.lognormvariate(0, 1) * (high - low) / 8))
+
+	return rng.randint(low, high)
+
+def unicode_text(count, rng):
+	return ' '.join(rng.choice(UNICODE_WORDS) for i in range(count))
+
+def random_bytes(size, rng):
+	return rng.getrandbits(size * 8).to_bytes(size, 'little')
+
+# A handful of non-ASCII words, enough to exercise escaping and UTF-8 encoding.
+UNICODE_WORDS = (
+	'naïve', 'café', 'Привет', 'мир', 'Ελληνικά', '日本語', '中文', '한국어',
+	'हिन्दी', 'العربية', 'עברית', 'ไทย', 'Ünïcödé', '😀', '🚀', '✓',
+)
+
+# Leaf value type -> function(profile, rng) returning a value of that type.
+LEAF_TYPES = {
+	# lipsum() can't return more words than the text has.
+	'str': lambda profile, rng: lipsum(min(string_length(profile, rng), len(lipsum_words()) - 1), rng),
+	'unicode': lambda profile, rng: unicode_text(string_length(profile, rng), rng),
+	'int': lambda profile, rng: rng.randint(-2 ** 31, 2 ** 31 - 1),
+	'bigint': lambda profile, rng: rng.getrandbits(128) * rng.choice((1, -1)),
+	'float': lambda profile, rng: rng.uniform(-1e6, 1e6),
+	'bytes': lambda profile, rng: random_bytes(rng.randint(*profile['bytes_len']), rng),
+	'array': lambda profile, rng: array.array('d', (rng.random() for i in range(rng.randint(*profile['bytes_len']) // 8))),
+	'bool': lambda profile, rng: rng.random() < 0.5,
+	'none': lambda profile, rng: None,
+}
+
+# Dicts with more keys than this are treated as maps (ids -> values) rather
+# than records when inferring a schema.
+MAP_THRESHOLD = 32
+
+def sample_profile(path):
+	"""
+		Loads a sample JSON document and returns a profile that synthesizes
+		look-alike data from its inferred schema. A top-level list is taken
+		as a list of sample entries, anything else as a single entry.
+	"""
+	try:
+		with open(path) as f:
+			doc = json.load(f)
+	except OSError as e:
+		raise SystemExit('Cannot read sample %s: %s' % (path, e))
+	except ValueError as e:
+		raise SystemExit('Sample %s is not valid JSON: %s' % (path, e))
+
+	samples = doc if isinstance(doc, list) and doc else [doc]
+	schema = functools.reduce(merge_schema, map(infer_schema, samples))
+
+	return register_profile('sample', 'look-alike data synthesized from %s' % path,
+		builder=functools.partial(sample_source, schema), accepts=('entries',), entries=len(samples))
+
+def sample_source(schema, profile, rng):
+	return [synthesize(schema, rng) for i in range(profile['entries'])]
+
+def infer_schema(value):
+	"""
+		Describes a decoded JSON value: types, string lengths and how many are
+		non-ASCII, numeric ranges, list lengths and dict fields with how often
+		each one is present.
+	"""
+	if value is None:
+		return {'type': 'none'}
+	if isinstance(value, bool):
+		return {'type': 'bool', 'true': int(value), 'count': 1}
+	if isinstance(value, int):
+		return {'type': 'int', 'min': value, 'max': value}
+	if isinstance(value, float):
+		return {'type': 'float', 'min': value, 'max': value}
+	if isinstance(value, str):
+		return {'type': 'str', 'min': len(value), 'max': len(value), 'count': 1, 'unicode': int(not value.isascii())}
+	if isinstance(value, list):
+		items = functools.reduce(merge_schema, map(infer_schema, value)) if value else None
+		return {'type': 'list', 'min': len(value), 'max': len(value), 'items': items}
+	if isinstance(value, dict):
+		if len(value) > MAP_THRESHOLD:
+			return {'type': 'map', 'min': len(value), 'max': len(value),
+				'keys': functools.reduce(merge_schema, map(infer_schema, value)),
+				'values': functools.reduce(merge_schema, map(infer_schema, value.values()))}
+		return {'type': 'dict', 'count': 1,
+			'fields': dict((key, infer_schema(item)) for key, item in value.items()),
+			'seen': dict((key, 1) for key in value)}
+
+	raise TypeError('Cannot infer a schema for %r' % type(value))
+
+def merge_schema(a, b):
+	"""
+		Combines the schemas of two values seen in the same position.
+	"""
+	if a is None or b is None:
+		return a or b
+
+	if a['type'] == 'union' or b['type'] == 'union' or a['type'] != b['type']:
+		options = list(a['options'] if a['type'] == 'union' else [a])
+		for schema in b['options'] if b['type'] == 'union' else [b]:
+			for i, option in enumerate(options):
+				if option['type'] == schema['type']:
+					options[i] = merge_schema(option, schema)
+					break
+			else:
+				options.append(schema)
+		return {'type': 'union', 'options': options}
+
+	merged = dict(a)
+	kind = a['type']
+	if 'min' in a:
+		merged['min'] = min(a['min'], b['min'])
+		merged['max'] = max(a['max'], b['max'])
+	if kind == 'bool':
+		merged['true'] = a['true'] + b['true']
+		merged['count'] = a['count'] + b['count']
+	elif kind == 'str':
+		merged['count'] = a['count'] + b['count']
+		merged['unicode'] = a['unicode'] + b['unicode']
+	elif kind == 'list':
+		merged['items'] = merge_schema(a['items'], b['items'])
+	elif kind == 'map':
+		merged['keys'] = merge_schema(a['keys'], b['keys'])
+		merged['values'] = merge_schema(a['values'], b['values'])
+	elif kind == 'dict':
+		merged['count'] = a['count'] + b['count']
+		merged['fields'] = dict(a['fields'])
+		merged['seen'] = dict(a['seen'])
+		for key, schema in b['fields'].items():
+			merged['fields'][key] = merge_schema(merged['fields'].get(key), schema)
+			merged['seen'][key] = merged['seen'].get(key, 0) + b['seen'][key]
+
+	return merged
+
+def synthesize(schema, rng):
+	"""
+		Generates a random value matching an inferred schema.
+	"""
+	kind = schema['type']
+	if kind == 'none':
+		return None
+	if kind == 'bool':
+		return rng.random() < schema['true'] / schema['count']
+	if kind == 'int':
+		return rng.randint(schema['min'], schema['max'])
+	if kind == 'float':
+		return rng.uniform(schema['min'], schema['max'])
+	if kind == 'str':
+		size = rng.randint(schema['min'], schema['max'])
+		# As many non-ASCII strings as the samples had.
+		if rng.random() < schema['unicode'] / schema['count']:
+			return unicode_text(size // 5 + 1, rng)[:size]
+		return lipsum(min(size // 5 + 1, len(lipsum_words()) - 1), rng)[:size]
+	if kind == 'union':
+		return synthesize(rng.choice(schema['options']), rng)
+	if kind == 'list':
+		if schema['items'] is None:
+			return []
+		return [synthesize(schema['items'], rng) for i in range(rng.randint(schema['min'], schema['max']))]
+	if kind == 'map':
+		return dict((synthesize(schema['keys'], rng), synthesize(schema['values'], rng))
+			for i in range(rng.randint(schema['min'], schema['max'])))
+	if kind == 'dict':
+		return dict((key, synthesize(field, rng)) for key, field in schema['fields'].items()
+			if rng.random() < schema['seen'][key] / schema['count'])
+
+	raise ValueError('Unknown schema type %r' % kind)
+
+def lipsum(count=50, rng=random):
 	"""
 		This function generates lorem ipsum junk, use with caution ;)
 	"""
-	lipsum = """
+	words = lipsum_words()
+	max_start = len(words) - count
+	start = rng.randrange(0, max_start)
+
+	output = ' '.join(words[start:start+count]).capitalize()
+
+	return output
+
+def lipsum_phrases(count=10, number=None, size=None, rng=None, seed=None):
+	"""
+		Bulk version of lipsum(), yields phrases of count words from one
+		random.Random until number phrases or size bytes (whichever comes
+		first) have been produced, forever if neither is given. It's about
+		as fast per phrase as lipsum() now that the words are cached, the
+		point is not having to count bytes yourself. 100MB takes seconds:
+
+		phrases = list(lipsum_phrases(10, size=100 * 1024 * 1024, seed=1))
+	"""
+	if rng is None:
+		rng = random.Random(seed)
+
+	words = lipsum_words()
+	max_start = len(words) - count
+	join = ' '.join
+	rand = rng.random
+
+	produced = 0
+	written = 0
+	while True:
+		# Start offsets are drawn 1024 at a time, the generator only stops between phrases.
+		for start in [int(rand() * max_start) for i in range(1024)]:
+			if number is not None and produced >= number:
+				return
+			if size is not None and written >= size:
+				return
+
+			phrase = join(words[start:start+count]).capitalize()
+			produced += 1
+			written += len(phrase)
+			yield phrase
+
+_lipsum_words = None
+
+def lipsum_words():
+	"""
+		Returns the lorem ipsum text below split into words. Splitting it is
+		what used to make lipsum() slow, so it's done once on first use.
+	"""
+	global _lipsum_words
+	if _lipsum_words is None:
+		_lipsum_words = tuple(LIPSUM.split())
+
+	return _lipsum_words
+
+LIPSUM = """
 		Donec ultrices ultricies libero, et tristique dolor euismod et. Cras volutpat nulla in turpis consequat et dignissim nunc rhoncus. Class aptent taciti sociosqu ad litora torquent per conubia nostra, per inceptos himenaeos. Sed sit amet odio dolor. Mauris fermentum, quam vel volutpat lobortis, tellus eros tempus est, varius elementum arcu lectus volutpat felis. Duis aliquam justo eget neque lacinia vitae dictum urna mollis. Praesent id congue ligula. Maecenas vehicula faucibus mauris, id auctor velit mattis nec. Nulla facilisi. In a mauris quis orci malesuada tempor. Etiam molestie consequat tortor, nec vestibulum enim feugiat ac. Aenean vehicula laoreet mauris, eget tristique urna ultrices vitae. Morbi enim orci, consectetur et ornare eu, sollicitudin in libero. Phasellus nisl nunc, iaculis sed scelerisque non, pretium vel mauris. Curabitur sit amet augue sit amet lacus pellentesque facilisis. Nam in ipsum nulla, eu molestie mi. Praesent eget elementum erat.
 		Vivamus ornare suscipit lectus, auctor eleifend mauris congue ut. Aenean vel ullamcorper ipsum. Aliquam erat volutpat. Fusce varius mollis nibh ut vestibulum. Nullam turpis velit, luctus id bibendum eu, commodo id lacus. Maecenas libero tortor, pretium at elementum et, pellentesque vitae magna. Morbi eu nulla eu dolor fermentum faucibus eu congue dui. Etiam eu nibh vitae neque rhoncus ultricies. Nunc vitae diam ligula, sit amet mollis libero. Ut fermentum nisl non sem commodo imperdiet. Morbi in mi vitae nunc eleifend varius eget sed nulla. Ut laoreet lacinia mi rhoncus luctus. Mauris blandit pretium ipsum, interdum gravida libero porttitor ut. Pellentesque habitant morbi tristique senectus et netus et malesuada fames ac turpis egestas.
 		Proin commodo, leo elementum gravida iaculis, urna leo imperdiet elit, ac congue dolor ante ornare tortor. Proin dapibus ultricies lorem, imperdiet posuere purus scelerisque et. Morbi nulla eros, mattis nec egestas sed, imperdiet eu nibh. In hac habitasse platea dictumst. Pellentesque habitant morbi tristique senectus et netus et malesuada fames ac turpis egestas. Curabitur pellentesque urna non diam dictum adipiscing. Duis vestibulum nibh mi, ac faucibus tortor. Fusce blandit diam eu odio viverra bibendum. Morbi a nunc tortor. Donec id odio dolor, vitae pulvinar massa.
@@ -143,13 +1701,5 @@ def lipsum(count=50):
 		Aliquam dui tortor, elementum ut tristique vel, euismod at libero. Pellentesque habitant morbi tristique senectus et netus et malesuada fames ac turpis egestas. Aliquam est metus, euismod in condimentum eu, porttitor et nisl. Aliquam eu vestibulum massa. Ut ac aliquam mauris. Donec ultrices bibendum nunc sit amet faucibus. Sed erat lacus, rhoncus at pharetra quis, semper eget nunc. Praesent luctus ligula in urna convallis viverra. Sed et faucibus elit. Aenean eleifend, dolor vel ultricies egestas, turpis tortor pharetra purus, non malesuada dolor lectus et quam. Proin et est ligula. Suspendisse faucibus placerat tincidunt. Nulla condimentum dictum magna. Nullam dignissim, dui at vulputate vulputate, urna libero porta mauris, pharetra viverra mi odio eget enim. Class aptent taciti sociosqu ad litora torquent per conubia nostra, per.
 	"""
 
-	words = lipsum.split()
-	max_start = len(words) - count
-	start = random.randrange(0, max_start)
-
-	output = ' '.join(words[start:start+count]).capitalize()
-
-	return output
-
 if __name__ == "__main__":
-	main()
+	sys.exit(main())